@@ -1,130 +1,121 @@
+import asyncio
 import json
 import re
 import os
 import shutil
-import subprocess
-from concurrent.futures import ProcessPoolExecutor, as_completed
 import argparse
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+VIDEO_ID_PATTERN = re.compile(r'[\w-]+')
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+
+# Maps the characters that are not allowed in filenames, and the control characters, to '_'
+SANITIZE_TABLE = {code: '_' for code in range(0x20)}
+SANITIZE_TABLE.update({ord(char): '_' for char in '<>:"/\\|?*'})
+
 
 def get_last_object_from_array(file_path):
     """
     Reads a JSON file and returns the last object in the array.
 
+    With orjson installed the file is parsed in one native call. Otherwise the array
+    elements are decoded one at a time and only the most recent one is kept, so the
+    whole playlist history is never held in memory as Python objects.
+
     Args:
         file_path (str): The path to the JSON file.
 
     Returns:
-        dict or None: The last object in the array, or None if the array is empty.
+        object or None: The last object in the array, or None if the array is empty.
     """
-    with open(file_path, 'r', encoding="UTF-8") as file:
-        data = json.load(file)
-
-    if not isinstance(data, list):
-        raise ValueError("The JSON data is not an array.")
-
-    return data[-1] if data else None
+    if orjson is not None:
+        with open(file_path, 'rb') as file:
+            data = orjson.loads(file.read())
 
+        if not isinstance(data, list):
+            raise ValueError("The JSON data is not an array.")
 
-def save_object_to_json(file_path, obj):
-    """
-    Saves a Python object as a pretty-printed JSON string in a text file.
+        return data[-1] if data else None
 
-    Args:
-        file_path (str): The path to the output text file.
-        obj (dict or list): The object to save.
-    """
-    json_string = json.dumps(obj, indent=4)
+    with open(file_path, 'r', encoding="UTF-8") as file:
+        content = file.read()
 
-    with open(file_path, 'w', encoding="UTF-8") as file:
-        file.write(json_string)
+    decoder = json.JSONDecoder()
+    position = JSON_WHITESPACE.match(content).end()
 
+    if content[position:position + 1] != '[':
+        raise ValueError("The JSON data is not an array.")
 
-def crop_cache_string(file_path, save_changes=False):
-    """
-    Crops '__CACHE:' from the start and a '"' from the end of the content in the given file.
+    last_object = None
+    position = JSON_WHITESPACE.match(content, position + 1).end()
 
-    Args:
-        file_path (str): The path to the text file.
-        save_changes (bool): If True, saves the changes to the file. If False, returns the modified content.
+    if content[position:position + 1] != ']':
+        while True:
+            last_object, position = decoder.raw_decode(content, position)
+            position = JSON_WHITESPACE.match(content, position).end()
+            separator = content[position:position + 1]
 
-    Returns:
-        str: The modified content if save_changes is False.
-    """
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
+            if separator == ']':
+                break
+            if separator != ',':
+                raise ValueError("The JSON array is malformed.")
 
-    if content.startswith('"__CACHE:'):
-        content = content[len('"__CACHE:'):]
+            position = JSON_WHITESPACE.match(content, position + 1).end()
 
-    if content.endswith('"'):
-        content = content[:-1]
+    if JSON_WHITESPACE.match(content, position + 1).end() != len(content):
+        raise ValueError("Extra data after the JSON array.")
 
-    if save_changes:
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(content)
-    else:
-        return content
+    return last_object
 
 
-def replace_and_remove_quotes(file_path, save_changes=False):
+def parse_cache_string(cache_string):
     """
-    Removes unescaped '"' from the content and replaces all occurrences of '\"' with '"'.
+    Crops '__CACHE:' from the start of a Grayjay cache string and parses the embedded JSON.
 
     Args:
-        file_path (str): The path to the text file.
-        save_changes (bool): If True, saves the changes to the file. If False, returns the modified content.
+        cache_string (str): The cache string taken from the playlist JSON.
 
     Returns:
-        str: The modified content if save_changes is False.
+        dict: The embedded JSON data as a Python dictionary.
     """
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
-
-    content_no_unescaped_quotes = re.sub(r'(?<!\\)"', '', content)
-    final_content = content_no_unescaped_quotes.replace(r'\"', '"')
-
-    if save_changes:
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(final_content)
-    else:
-        return final_content
+    start = len('__CACHE:') if cache_string.startswith('__CACHE:') else 0
+    return load_json(cache_string, start)
 
 
-def load_json(json_str):
+def load_json(json_str, start=0):
     """
     Loads a JSON string and returns its content as a Python variable.
 
+    Without orjson the document is decoded in place from the start index, so cropping a
+    prefix doesn't copy the whole string first.
+
     Args:
         json_str (str): The JSON string.
+        start (int, optional): The index in json_str where the JSON document begins.
 
     Returns:
         dict or list: The content of the JSON string as a Python dictionary or list.
     """
-    return json.loads(json_str)
-
-
-def remove_escaped_quotes(file_path, save_changes=False):
-    """
-    Removes all occurrences of '\\"' from the content of the given file.
-
-    Args:
-        file_path (str): The path to the text file.
-        save_changes (bool): If True, saves the changes to the file. If False, returns the modified content.
+    if orjson is not None:
+        return orjson.loads(json_str[start:] if start else json_str)
 
-    Returns:
-        str: The modified content if save_changes is False.
-    """
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
+    data, end = json.JSONDecoder().raw_decode(json_str, JSON_WHITESPACE.match(json_str, start).end())
 
-    modified_content = content.replace(r'\\"', '')
+    if JSON_WHITESPACE.match(json_str, end).end() != len(json_str):
+        raise ValueError("Extra data after the JSON document.")
 
-    if save_changes:
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(modified_content)
-    else:
-        return modified_content
+    return data
 
 
 def filter_json_data(data):
@@ -157,9 +148,85 @@ def sanitize_filename(name):
     Returns:
         str: The sanitized filename.
     """
-    return re.sub(r'[<>:"/\\|?*\x00-\x1F]', '_', name)
+    return name.translate(SANITIZE_TABLE)
+
+def scan_directory(directory):
+    """
+    Lists the files in a directory with a single os.scandir pass.
+
+    The returned entries carry their name, path and file type from the directory listing
+    itself, so callers can classify them by name and type without a stat call. Sizes and
+    other metadata still cost one stat per entry through DirEntry.stat().
+
+    Args:
+        directory (str): The path to the directory to scan.
+
+    Returns:
+        list: The os.DirEntry objects of the regular files in the directory.
+    """
+    with os.scandir(directory) as scanner:
+        return [entry for entry in scanner if entry.is_file()]
+
+
+def get_mp3_file_path(file_path, directory):
+    """
+    Returns the path of the .mp3 file that a media file is converted to.
+
+    Args:
+        file_path (str): The path to the file to convert.
+        directory (str): The directory where the .mp3 file is saved.
+
+    Returns:
+        str: The path to the .mp3 file.
+    """
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(directory, f"{base_name}.mp3")
+
+
+def get_partial_file_path(file_path, directory):
+    """
+    Returns the temporary path ffmpeg writes to while a media file is being converted.
+
+    The .mp3 file only appears once the conversion has finished, so an interrupted
+    run never leaves a truncated .mp3 behind.
+
+    Args:
+        file_path (str): The path to the file to convert.
+        directory (str): The directory where the .mp3 file is saved.
+
+    Returns:
+        str: The path to the partial .mp3 file.
+    """
+    return f"{get_mp3_file_path(file_path, directory)}.part"
 
-def convert_file_to_mp3(file_path, directory):
+
+def finish_mp3_file(file_path, directory):
+    """
+    Moves a finished conversion onto its .mp3 name and removes the original file.
+
+    Args:
+        file_path (str): The path to the converted file.
+        directory (str): The directory where the .mp3 file is saved.
+    """
+    os.replace(get_partial_file_path(file_path, directory), get_mp3_file_path(file_path, directory))
+    os.remove(file_path)
+
+
+async def run_ffmpeg(command):
+    """
+    Runs an ffmpeg command as a child process and waits for it to exit.
+
+    Args:
+        command (list): The ffmpeg command and its arguments.
+
+    Returns:
+        bool: True if ffmpeg exited successfully, False otherwise.
+    """
+    process = await asyncio.create_subprocess_exec(*command)
+    return await process.wait() == 0
+
+
+async def convert_file_to_mp3(file_path, directory):
     """
     Converts a single .webma or .mp4a file to .mp3 format and removes the original file.
 
@@ -170,63 +237,219 @@ def convert_file_to_mp3(file_path, directory):
     Returns:
         tuple: A tuple containing the filename and a boolean indicating success or failure.
     """
-    base_name = os.path.splitext(os.path.basename(file_path))[0]
-    mp3_filename = f"{base_name}.mp3"
-    mp3_file_path = os.path.join(directory, mp3_filename)
-
+    partial_file_path = get_partial_file_path(file_path, directory)
     command = [
-        'ffmpeg', '-i', file_path,
+        'ffmpeg', '-y', '-nostdin',  # Don't read the terminal alongside the other ffmpeg processes
+        '-threads', '1', '-i', file_path,  # Single-threaded decode
         '-q:a', '0',  # Best audio quality
         '-map', 'a',
+        '-threads', '1',  # Single-threaded encode
         '-loglevel', 'error',  # Suppress output unless there's an error
-        mp3_file_path
+        '-f', 'mp3', partial_file_path  # The .part name doesn't tell ffmpeg the format
     ]
 
-    try:
-        subprocess.run(command, check=True)
-        os.remove(file_path)
+    if await run_ffmpeg(command):
+        finish_mp3_file(file_path, directory)
         return (file_path, True)
-    except subprocess.CalledProcessError:
-        return (file_path, False)
-        
-def convert_folder_to_mp3(directory, max_workers=None):
+
+    if os.path.exists(partial_file_path):
+        os.remove(partial_file_path)
+    return (file_path, False)
+
+
+async def convert_files_to_mp3(file_paths, directory):
+    """
+    Converts a batch of .webma or .mp4a files to .mp3 format with a single ffmpeg process
+    and removes the original files.
+
+    Every file is passed as a separate input with its own output, so ffmpeg's startup and
+    codec initialisation are paid once per batch. If the batch fails, the files are retried
+    one by one to find out which of them failed.
+
+    Args:
+        file_paths (list): The paths to the files to convert.
+        directory (str): The directory where the files are located.
+
+    Returns:
+        list: A list of tuples containing the filename and a boolean indicating success or failure.
+    """
+    command = ['ffmpeg', '-y', '-nostdin', '-loglevel', 'error']  # Suppress output unless there's an error
+    for file_path in file_paths:
+        command += ['-threads', '1', '-i', file_path]  # Single-threaded decode
+    for index, file_path in enumerate(file_paths):
+        command += [
+            '-map', f'{index}:a',
+            '-q:a', '0',  # Best audio quality
+            '-threads', '1',  # Single-threaded encode
+            '-f', 'mp3', get_partial_file_path(file_path, directory)
+        ]
+
+    if not await run_ffmpeg(command):
+        return [await convert_file_to_mp3(file_path, directory) for file_path in file_paths]
+
+    for file_path in file_paths:
+        finish_mp3_file(file_path, directory)
+    return [(file_path, True) for file_path in file_paths]
+
+
+def convert_folder_to_mp3(directory, max_workers=None, batch_size=8):
     """
     Converts .webma and .mp4a files in the specified directory to .mp3 format with high quality,
-    using multiple processes to speed up the conversion. Tracks the progress and counts the number
-    of successful and failed conversions.
+    running several ffmpeg processes at once to speed up the conversion. Tracks the progress and
+    counts the number of successful and failed conversions.
+
+    ffmpeg writes to a temporary .mp3.part file that is moved onto the .mp3 name only on
+    success; part files left behind by an interrupted run are removed. Files that already
+    have a matching .mp3 next to them and empty files are skipped, so re-running the tool
+    only converts what is new.
+
+    The ffmpeg processes are started directly from this process and awaited with asyncio,
+    so no Python worker processes are needed.
 
     Args:
         directory (str): The path to the directory containing the files to convert.
-        max_workers (int, optional): The maximum number of worker processes to use. If None, uses the number of available CPU cores.
+        max_workers (int, optional): The maximum number of files converted at once, across all ffmpeg processes. If None, uses the number of available CPU cores.
+        batch_size (int, optional): The maximum number of files converted by a single ffmpeg process. Lowered as needed so the batches split max_workers evenly.
     """
-    files_to_convert = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.webma') or f.endswith('.mp4a')]
+    entries = scan_directory(directory)
+    mp3_names = {entry.name for entry in entries if entry.name.endswith('.mp3')}
+
+    # Nothing is converting yet, so any part file is left over from an interrupted run
+    for entry in entries:
+        if entry.name.endswith('.mp3.part'):
+            os.remove(entry.path)
+
+    # Skip files already converted by an earlier run, and empty downloads
+    files_to_convert = []
+    for entry in entries:
+        if not entry.name.endswith(('.webma', '.mp4a')):
+            continue
+
+        mp3_filename = f"{os.path.splitext(entry.name)[0]}.mp3"
+        if mp3_filename in mp3_names:
+            print(f"Skipping '{entry.name}', '{mp3_filename}' already exists")
+        elif entry.stat().st_size == 0:
+            print(f"Skipping empty file '{entry.name}'")
+        else:
+            files_to_convert.append(entry.path)
     total_files = len(files_to_convert)
     success_count = 0
     failure_count = 0
 
-    print("Converting to MP3")
+    # Each codec is pinned to one thread, but ffmpeg runs every file of a batch in its own
+    # threads, so concurrency is limited by files: at most max_workers encodes run at once
+    max_workers = max_workers or os.cpu_count() or 1
+
+    # Batches never exceed max_workers, and shrink for short lists so every worker gets a file.
+    # The workers are then split into equal slots of one batch each.
+    batch_size = max(1, min(batch_size, max_workers, -(-total_files // max_workers)))
+    slot_count = -(-max_workers // batch_size)
+    batch_size = max_workers // slot_count
+    batches = [files_to_convert[i:i + batch_size] for i in range(0, total_files, batch_size)]
+    progress_step = max(1, total_files // 100)
+
+    async def convert_batches():
+        nonlocal success_count, failure_count
+        semaphore = asyncio.Semaphore(slot_count)
+
+        async def convert_batch(batch):
+            async with semaphore:
+                return await convert_files_to_mp3(batch, directory)
+
+        for future in asyncio.as_completed([convert_batch(batch) for batch in batches]):
+            for filename, success in await future:
+                if success:
+                    success_count += 1
+                else:
+                    failure_count += 1
+
+                # Print progress at most about 100 times, but always report failures
+                completed = success_count + failure_count
+                if not success or completed % progress_step == 0:
+                    print(f"Convert to MP3: {completed}/{total_files} - Success: {success_count}, Failures: {failure_count}")
 
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(convert_file_to_mp3, file_path, directory): file_path for file_path in files_to_convert}
-        
-        for future in as_completed(futures):
-            filename, success = future.result()
-            if success:
-                success_count += 1
-            else:
-                failure_count += 1
+    print("Converting to MP3")
 
-            # Print progress
-            print(f"Convert to MP3: {success_count + failure_count}/{total_files} - Success: {success_count}, Failures: {failure_count}")
+    asyncio.run(convert_batches())
 
     print(f"Conversion completed. Total: {total_files}, Successful: {success_count}, Failed: {failure_count}")
 
 
+def copy_file(source_path, destination_path):
+    """
+    Copies a file's contents, cloning it as a reflink when the filesystem supports it.
+
+    A reflink shares the source's data blocks on copy-on-write filesystems, so no bytes are
+    copied. Otherwise falls back to shutil.copyfile, which uses os.sendfile on Linux.
+
+    Args:
+        source_path (str): The path to the file to copy.
+        destination_path (str): The path to the copy, including its filename.
+
+    Returns:
+        str: The destination path.
+
+    Raises:
+        shutil.SameFileError: If the destination is the source file itself.
+    """
+    # Opening the destination truncates it, so refuse before that can empty the source
+    if os.path.exists(destination_path) and os.path.samefile(source_path, destination_path):
+        raise shutil.SameFileError(f"{source_path!r} and {destination_path!r} are the same file")
+
+    if fcntl is not None:
+        try:
+            with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+                fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+            return destination_path
+        except OSError:
+            pass
+
+    return shutil.copyfile(source_path, destination_path)
+
+
+def index_files_by_video_id(entries, video_ids):
+    """
+    Groups directory entries by the playlist video ID at the start of their filename.
+
+    Filenames like '<id>.<ext>', '<id> [<quality>].<ext>' and '<id>_<suffix>.<ext>' are all
+    matched. IDs may contain '_' themselves, so a filename is filed under the longest of its
+    leading ID token and that token's '_'-prefixes that is a playlist video ID. Each file
+    therefore belongs to at most one video.
+
+    Args:
+        entries (list): The os.DirEntry objects of the files to index.
+        video_ids (set or dict): The video IDs of the playlist.
+
+    Returns:
+        dict: A mapping of video ID to the list of entries whose filename starts with it.
+    """
+    files_by_id = {}
+    for entry in entries:
+        match = VIDEO_ID_PATTERN.match(entry.name)
+        if not match:
+            continue
+
+        video_id = match.group()
+        while video_id not in video_ids:
+            separator = video_id.rfind('_')
+            if separator == -1:
+                break
+            video_id = video_id[:separator]
+        else:
+            files_by_id.setdefault(video_id, []).append(entry)
+    return files_by_id
+
+
 def rename_files_based_on_json(json_data, input_directory, output_directory):
     """
     Copies files from the input directory to the output directory, renames them based on 
     'value' and 'name' fields from the JSON data, and saves the renamed files to the output directory.
 
+    The input directory is scanned once and indexed by video ID, so each video is matched
+    with an exact dictionary lookup instead of a fresh directory listing. All copies are planned
+    before the first one is made, then carried out in a single pass. Videos whose '<name>.mp3'
+    is already in the output directory are not copied again.
+
     Args:
         json_data (dict): The JSON data containing video details.
         input_directory (str): The path to the directory where the original files are located.
@@ -234,29 +457,45 @@ def rename_files_based_on_json(json_data, input_directory, output_directory):
     """
     videos = json_data.get("videos", [])
 
+    # Sanitize every name once, before touching the filesystem
+    names_by_id = {}
     for video in videos:
         value = video.get("value")
-        name = sanitize_filename(video.get("name"))
+        name = video.get("name")
 
         if not value or not name:
             print(f"Skipping due to missing 'value' or 'name' for video: {video}")
             continue
 
-        for filename in os.listdir(input_directory):
-            if value in filename:
-                old_file_path = os.path.join(input_directory, filename)
-                file_extension = os.path.splitext(filename)[1]
-                name_with_extension = f"{name}{file_extension}"
-                new_file_path = os.path.join(output_directory, name_with_extension)
+        names_by_id[value] = sanitize_filename(name)
+
+    files_by_id = index_files_by_video_id(scan_directory(input_directory), names_by_id)
+    mp3_names = {entry.name for entry in scan_directory(output_directory) if entry.name.endswith('.mp3')}
+
+    # Work out every (source, destination) pair before touching the output directory
+    copies = []
+    converted_count = 0
+    for value, name in names_by_id.items():
+        if f"{name}.mp3" in mp3_names:
+            converted_count += 1
+            continue
+
+        if value not in files_by_id:
+            print(f"No downloaded file for video '{value}' ({name})")
+            continue
 
-                # Copy the file to the output directory first
-                copied_file_path = shutil.copy(old_file_path, output_directory)
+        for entry in files_by_id[value]:
+            file_extension = os.path.splitext(entry.name)[1]
+            copies.append((entry, f"{name}{file_extension}"))
 
-                # Rename the copied file in the output directory
-                os.rename(copied_file_path, new_file_path)
+    for entry, name_with_extension in copies:
+        # Copy straight to the final name, the original stays in Grayjay's downloads
+        copy_file(entry.path, os.path.join(output_directory, name_with_extension))
 
-                print(f"Copied '{filename}' to '{output_directory}', then renamed to '{name_with_extension}'")
+        print(f"Copied '{entry.name}' to '{output_directory}' as '{name_with_extension}'")
 
+    if converted_count:
+        print(f"Skipped {converted_count} video(s) already converted to MP3 in '{output_directory}'")
 
 
 DEFAULT_GRAYJAY_FOLDER = "/data/data/com.futo.platformplayer/files/downloads/"
@@ -266,12 +505,7 @@ DEFAULT_PLAYLIST_JSON = DEFAULT_WORK_FOLDER + 'playlist.json'   #/sdcard/Music/g
 
 def grayjay_pl_dl(grayjay_dl_folder=DEFAULT_GRAYJAY_FOLDER, output_folder=DEFAULT_WORK_FOLDER, grayjay_playlist_json=DEFAULT_PLAYLIST_JSON, convert_to_mp3=True):
     last_object = get_last_object_from_array(grayjay_playlist_json)
-    save_object_to_json(output_folder + 'cache.json', last_object)
-
-    crop_cache_string(output_folder + 'cache.json', save_changes=True)
-    replace_and_remove_quotes(output_folder + 'cache.json', save_changes=True)
-    modified_content = remove_escaped_quotes(output_folder + 'cache.json', save_changes=False)
-    useful_json = load_json(modified_content)
+    useful_json = parse_cache_string(last_object)
     useful_json = filter_json_data(useful_json)
 
     rename_files_based_on_json(useful_json, grayjay_dl_folder, output_folder)